@@ -31,7 +31,6 @@ import imp
 import time
 import random
 import codecs
-import rdflib
 
 import numpy as np
 
@@ -42,7 +41,7 @@ from zamiaprolog.logicdb import LogicDB
 from zamiaprolog.logic   import StringLiteral, ListLiteral, NumberLiteral
 from zamiaprolog.errors  import PrologError
 from aiprolog.pl2rdf     import pl_literal_to_rdf
-from aiprolog.runtime    import AIPrologRuntime, CONTEXT_GRAPH_NAME, USER_PREFIX, CURIN, KB_PREFIX, DEFAULT_USER, \
+from aiprolog.runtime    import AIPrologRuntime, CONTEXT_GRAPH, USER_PREFIX, CURIN, KB_PREFIX, DEFAULT_USER, \
                                 TEST_USER, TEST_TIME
 from aiprolog.parser     import AIPrologParser
 
@@ -238,12 +237,13 @@ class AIKernal(object):
                 self.session.commit()
 
             if run_init:
-                gn = rdflib.Graph(identifier=CONTEXT_GRAPH_NAME)
+                gn = CONTEXT_GRAPH
                 self.kb.remove((CURIN, None, None, gn))
 
                 quads = [ ( CURIN, KB_PREFIX+u'user', DEFAULT_USER, gn) ]
 
                 self.kb.addN_resolve(quads)
+                self.prolog_rt.clear_context_cache()
 
                 prolog_s = u'init(\'%s\')' % (module_name)
                 c = self.parser.parse_line_clause_body(prolog_s)
@@ -359,7 +359,7 @@ class AIKernal(object):
 
         """ process user input, return action(s) """
 
-        gn = rdflib.Graph(identifier=CONTEXT_GRAPH_NAME)
+        gn = CONTEXT_GRAPH
 
         tokens = tokenize(utterance, utt_lang)
 
@@ -377,6 +377,7 @@ class AIKernal(object):
             quads.append( ( CURIN, KB_PREFIX+u'currentTime', pl_literal_to_rdf(NumberLiteral(time.time()), self.kb), gn ) )
    
         self.kb.addN_resolve(quads)
+        self.prolog_rt.clear_context_cache()
 
         self.prolog_rt.reset_actions()
         self.prolog_rt.set_trace(trace)
@@ -487,7 +488,7 @@ class AIKernal(object):
 
         logging.info('running tests of module %s ...' % (module_name))
 
-        gn = rdflib.Graph(identifier=CONTEXT_GRAPH_NAME)
+        gn = CONTEXT_GRAPH
 
         for nlpt in self.db.session.query(model.NLPTest).filter(model.NLPTest.module==module_name):
 
@@ -500,6 +501,7 @@ class AIKernal(object):
             quads = [ ( CURIN, KB_PREFIX+u'user', TEST_USER, gn) ]
 
             self.kb.addN_resolve(quads)
+            self.prolog_rt.clear_context_cache()
 
             prolog_s = u'test_setup(\'%s\')' % (module_name)
             c = self.parser.parse_line_clause_body(prolog_s)
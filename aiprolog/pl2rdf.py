@@ -23,192 +23,431 @@
 # - from prolog literals to rdflib literals and back
 #
 
-import sys
-import datetime
-import dateutil.parser
 import time
-import pytz # $ pip install pytz
 import json
 import rdflib
 from rdflib.plugins.sparql.parserutils import CompValue
-import logging
-
-from tzlocal import get_localzone # $ pip install tzlocal
 
 from zamiaprolog.errors  import PrologError, PrologRuntimeError
-from zamiaprolog.logic   import NumberLiteral, StringLiteral, ListLiteral, Variable, Predicate, Literal
-
-import model
+from zamiaprolog.logic   import NumberLiteral, StringLiteral, ListLiteral, Variable, Predicate
 
 DT_LIST     = u'http://ai.zamia.org/types/list'
 DT_CONSTANT = u'http://ai.zamia.org/types/constant'
 
+_Literal      = rdflib.term.Literal
+_URIRef       = rdflib.term.URIRef
+_Variable     = rdflib.term.Variable
+
+_XSD_DECIMAL  = rdflib.namespace.XSD.decimal
+_XSD_FLOAT    = rdflib.namespace.XSD.float
+_XSD_INT      = rdflib.namespace.XSD.integer
+_XSD_DT       = rdflib.namespace.XSD.dateTime
+_XSD_DATE     = rdflib.namespace.XSD.date
+_DT_LIST_REF  = rdflib.term.URIRef(DT_LIST)
+_DT_CONST_REF = rdflib.term.URIRef(DT_CONSTANT)
+
+#
+# type -> json dict for PrologJSONEncoder.default(), constants (which depend
+# on the predicate's arity) are handled there. _JSON_DEFAULT_ISINSTANCE keeps
+# the order in which default() tries isinstance() for subclasses, which miss
+# the exact type lookup in _JSON_DEFAULT.
+#
+
+_JSON_DEFAULT_ISINSTANCE = (
+                             (NumberLiteral , lambda o: {'pt': 'NumberLiteral', 'f': o.f}),
+                             (ListLiteral   , lambda o: {'pt': 'ListLiteral',   'l': o.l}),
+                             (StringLiteral , lambda o: {'pt': 'StringLiteral', 's': o.s}),
+                           )
+
+_JSON_DEFAULT = dict(_JSON_DEFAULT_ISINSTANCE)
+
 class PrologJSONEncoder(json.JSONEncoder):
 
     def default(self, o):
-        
-        if isinstance (o, NumberLiteral):
-            return {'pt': 'NumberLiteral', 'f': o.f}
-
-        elif isinstance (o, ListLiteral):
-            return {'pt': 'ListLiteral', 'l': o.l}
-        
-        elif isinstance (o, StringLiteral):
-            return {'pt': 'StringLiteral', 's': o.s}
-        
-        elif isinstance (o, Predicate) and len(o.args)==0:
-            return {'pt': 'Constant', 'name': o.name}
-        
+
+        f = _JSON_DEFAULT.get(type(o))
+        if f is not None:
+            return f(o)
+
+        if isinstance (o, Predicate):
+            if len(o.args)==0:
+                return {'pt': 'Constant', 'name': o.name}
+
+        else:
+            for t, f in _JSON_DEFAULT_ISINSTANCE:
+                if isinstance (o, t):
+                    return f(o)
 
         return json.JSONEncoder.default(self, o)
 
+_PL_FROM_JSON = {
+                  'Constant'     : lambda o: Predicate     (o['name']),
+                  'StringLiteral': lambda o: StringLiteral (o['s']),
+                  'NumberLiteral': lambda o: NumberLiteral (o['f']),
+                  'ListLiteral'  : lambda o: ListLiteral   (o['l']),
+                 }
+
 def _prolog_from_json(o):
 
-    if o['pt'] == 'Constant':
-        return Predicate(o['name'])
-    if o['pt'] == 'StringLiteral':
-        return StringLiteral (o['s'])
-    if o['pt'] == 'NumberLiteral':
-        return NumberLiteral (o['f'])
-    if o['pt'] == 'ListLiteral':
-        return ListLiteral (o['l'])
+    try:
+        return _PL_FROM_JSON[o['pt']](o)
+    except KeyError:
+        raise PrologRuntimeError('cannot convert from json: %s .' % repr(o))
+
+# encoder/decoder keep no per-call state, so we share one instance of each
+
+_PL_JSON_ENCODER = PrologJSONEncoder()
+_PL_JSON_DECODER = json.JSONDecoder(object_hook = _prolog_from_json)
+
+
+#
+# datatype handlers get the rdflib literal itself and only build its
+# lexical form (unicode(l)) if they actually need it
+#
+
+def _rdf_number_to_pl(l):
+    return NumberLiteral(float(l))
+
+# xsd:integer values beyond 2**53 (ids, high resolution timestamps) would
+# lose precision as floats, so those stay ints. smaller values keep the float
+# representation the rest of the runtime expects (python 2 int / int truncates).
+
+_MAX_EXACT_FLOAT_INT = 2**53
+
+def _rdf_integer_to_pl(l):
 
-    raise PrologRuntimeError('cannot convert from json: %s .' % repr(o))
+    try:
+        i = int(unicode(l))
+    except ValueError:
+        # non-canonical lexical forms like '5.0' or '1e3'
+        return NumberLiteral(float(l))
 
+    if -_MAX_EXACT_FLOAT_INT <= i <= _MAX_EXACT_FLOAT_INT:
+        return NumberLiteral(float(i))
+    return NumberLiteral(i)
+
+#
+# xsd:dateTime and xsd:date use fixed ISO 8601 lexical forms which time.strptime
+# handles a lot faster than dateutil. fractional seconds and time zones are
+# dropped either way (timestamps are computed from local wall clock time), so
+# we only parse the leading date/time part and leave anything unusual to dateutil
+# (imported on demand only).
+#
+
+_XSD_DT_FMT   = '%Y-%m-%dT%H:%M:%S'
+_XSD_DATE_FMT = '%Y-%m-%d'
+
+def _rdf_datetime_to_pl(l):
+
+    value = unicode(l)
+
+    # only zone-less values take the strptime() shortcut: dateutil's timetuple()
+    # of zoned values has tm_isdst=0, which mktime() has to see as well
+
+    try:
+        rest = value[19:]
+        if rest and (rest[0] != '.' or 'Z' in rest or '+' in rest or '-' in rest):
+            raise ValueError
+        tt = time.strptime(value[:19], _XSD_DT_FMT)
+    except ValueError:
+        import dateutil.parser
+        tt = dateutil.parser.parse(value).timetuple()
+
+    return NumberLiteral(time.mktime(tt))
+
+def _rdf_date_to_pl(l):
+
+    value = unicode(l)
+
+    try:
+        tt = time.strptime(value, _XSD_DATE_FMT)
+    except ValueError:
+        import dateutil.parser
+        tt = dateutil.parser.parse(value).timetuple()
+
+    return NumberLiteral(time.mktime(tt))
+
+def _rdf_list_to_pl(l):
+    return _PL_JSON_DECODER.decode(unicode(l))
+
+def _rdf_constant_to_pl(l):
+    return Predicate (unicode(l))
+
+_RDF_DATATYPE_HANDLERS = {
+                           _XSD_DECIMAL : _rdf_number_to_pl,
+                           _XSD_FLOAT   : _rdf_number_to_pl,
+                           _XSD_INT     : _rdf_integer_to_pl,
+                           _XSD_DT      : _rdf_datetime_to_pl,
+                           _XSD_DATE    : _rdf_date_to_pl,
+                           _DT_LIST_REF : _rdf_list_to_pl,
+                           _DT_CONST_REF: _rdf_constant_to_pl,
+                         }
 
 def rdf_to_pl(l):
 
-    value    = unicode(l)
-
-    if isinstance (l, rdflib.Literal) :
-        if l.datatype:
-
-            datatype = str(l.datatype)
-
-            if datatype == 'http://www.w3.org/2001/XMLSchema#decimal':
-                value = NumberLiteral(float(value))
-            elif datatype == 'http://www.w3.org/2001/XMLSchema#float':
-                value = NumberLiteral(float(value))
-            elif datatype == 'http://www.w3.org/2001/XMLSchema#integer':
-                value = NumberLiteral(float(value))
-            elif datatype == 'http://www.w3.org/2001/XMLSchema#dateTime':
-                dt = dateutil.parser.parse(value)
-                value = NumberLiteral(time.mktime(dt.timetuple()))
-            elif datatype == 'http://www.w3.org/2001/XMLSchema#date':
-                dt = dateutil.parser.parse(value)
-                value = NumberLiteral(time.mktime(dt.timetuple()))
-            elif datatype == DT_LIST:
-                value = json.JSONDecoder(object_hook = _prolog_from_json).decode(value)
-            elif datatype == DT_CONSTANT:
-                value = Predicate (value)
-            else:
-                raise PrologRuntimeError('sparql_query: unknown datatype %s .' % datatype)
-        else:
-            if l.value is None:
-                value = ListLiteral([])
-            else:
-                value = StringLiteral(value)
-   
-    else:
-        value = StringLiteral(value)
-
-    return value
+    # called once per cell of every result set: URIRefs are recognized by
+    # a plain type() check before we resort to isinstance()
+
+    if type(l) is _URIRef or not isinstance (l, _Literal) :
+        return StringLiteral(unicode(l))
+
+    datatype = l.datatype
+
+    # plain literals are by far the most common case
+
+    if datatype is None:
+        if l.value is None:
+            return ListLiteral([])
+        return StringLiteral(unicode(l))
+
+    f = _RDF_DATATYPE_HANDLERS.get(datatype)
+    if f is None:
+        raise PrologRuntimeError('sparql_query: unknown datatype %s .' % datatype)
+
+    return f(l)
     
-def pl_literal_to_rdf(a, kb):
+#
+# strings that look like a URL/URI/IRI are mapped to URIRefs
+# (if this shows up in profiles, the result could be cached on StringLiteral)
+#
+
+_IRI_PREFIXES = ('http://', 'https://', 'urn:')
 
-    if isinstance (a, NumberLiteral):
-        return rdflib.term.Literal (str(a.f), datatype=rdflib.namespace.XSD.decimal)
+def _is_iri(s):
+    return s.startswith(_IRI_PREFIXES)
 
-    if isinstance (a, StringLiteral):
-        if a.s.startswith('http://'): # a URL/URI/IRI, apparently
-            return rdflib.term.URIRef (a.s)
-        return rdflib.term.Literal (a.s)
-        
-    if isinstance (a, ListLiteral):
-        return rdflib.term.Literal (PrologJSONEncoder().encode(a), datatype=DT_LIST)
+def _number_to_rdf(a, kb):
+    return _Literal (str(a.f), datatype=_XSD_DECIMAL)
 
-    if isinstance (a, Predicate):
+def _string_to_rdf(a, kb):
+    if _is_iri(a.s):
+        return _URIRef (a.s)
+    return _Literal (a.s)
 
-        if len(a.args) > 0:
-            raise PrologError('pl_literal_to_rdf: only constants are supported, found instead: %s (%s)' % (a.__class__, repr(a)))
+def _pl_to_json(o):
 
-        name = kb.resolve_aliases_prefixes(a.name)
+    # turn list literals into plain dicts/lists up front so json's C encoder
+    # does not have to call back into PrologJSONEncoder.default() per node.
+    # anything we do not know about is left to default().
 
-        if name.startswith('http://'):
-            return rdflib.term.URIRef(name)
+    t = type(o)
+
+    if t is ListLiteral:
+        return {'pt': 'ListLiteral', 'l': [_pl_to_json(e) for e in o.l]}
+
+    if t is Predicate:
+        if len(o.args)==0:
+            return {'pt': 'Constant', 'name': o.name}
+        return o
 
-        return rdflib.term.Literal (a.name, datatype=DT_CONSTANT)
+    f = _JSON_DEFAULT.get(t)
+    if f is not None:
+        return f(o)
+
+    return o
+
+def _list_to_rdf(a, kb):
+    return _Literal (_PL_JSON_ENCODER.encode(_pl_to_json(a)), datatype=_DT_LIST_REF)
+
+# constants resolve to a small set of IRIs which are converted over and over
+# again, keyed by the resolved name so alias/prefix changes need no invalidation
+
+MAX_RDF_IRIS = 4096
+_RDF_IRIS    = {} # resolved name -> rdflib.term.URIRef
+
+def _constant_to_rdf(a, kb):
+
+    global _RDF_IRIS
+
+    if len(a.args) > 0:
+        raise PrologError('pl_literal_to_rdf: only constants are supported, found instead: %s (%s)' % (a.__class__, repr(a)))
+
+    name = kb.resolve_aliases_prefixes(a.name)
+
+    iri = _RDF_IRIS.get(name)
+    if iri is not None:
+        return iri
+
+    if _is_iri(name):
+        if len(_RDF_IRIS) >= MAX_RDF_IRIS:
+            _RDF_IRIS = {}
+        iri = _RDF_IRIS[name] = _URIRef(name)
+        return iri
+
+    return _Literal (a.name, datatype=_DT_CONST_REF)
+
+#
+# type -> converter. _PL2RDF_ISINSTANCE keeps the order in which
+# pl_literal_to_rdf tries isinstance() for subclasses, which miss the exact
+# type lookup in _PL2RDF.
+#
+
+_PL2RDF_ISINSTANCE = (
+                       (NumberLiteral , _number_to_rdf),
+                       (StringLiteral , _string_to_rdf),
+                       (ListLiteral   , _list_to_rdf),
+                       (Predicate     , _constant_to_rdf),
+                     )
+
+_PL2RDF = dict(_PL2RDF_ISINSTANCE)
+
+def pl_literal_to_rdf(a, kb):
+
+    f = _PL2RDF.get(type(a))
+    if f is not None:
+        return f(a, kb)
+
+    for t, f in _PL2RDF_ISINSTANCE:
+        if isinstance (a, t):
+            return f(a, kb)
 
     raise PrologError('pl_literal_to_rdf: unknown argument type: %s (%s)' % (a.__class__, repr(a)))
 
-def pl_to_rdf(term, env, pe, var_map, kb):
+# rdflib variables are immutable and only depend on their name, so they
+# are shared across queries
+
+MAX_RDF_VARIABLES = 4096
+_RDF_VARIABLES    = {} # name -> rdflib.term.Variable
+
+def _rdf_variable(name, var_map, vars_set):
+
+    global _RDF_VARIABLES
+
+    rv = var_map.get(name)
+    if rv is None:
+        rv = _RDF_VARIABLES.get(name)
+        if rv is None:
+            if len(_RDF_VARIABLES) >= MAX_RDF_VARIABLES:
+                _RDF_VARIABLES = {}
+            rv = _RDF_VARIABLES[name] = _Variable(name)
+        var_map[name] = rv
+        if vars_set is not None:
+            vars_set.add(rv)
+    return rv
+
+def _term_to_rdf(term, env, _eval, var_map, kb, vars_set):
+
+    """ shared by pl_to_rdf() and pl_triple_to_rdf(), _eval is
+        pe.prolog_eval or None """
+
+    # logic classes are not subclassed in practice, so exact type checks
+    # decide the common cases and isinstance() only runs for the rest
 
-    if pe:
-        a = pe.prolog_eval(term, env)
-    else:
-        a = term
+    t = type(term)
+    if t is Variable or (t is not Predicate and isinstance (term, Variable)):
 
-    if (not pe or not a) and isinstance (term, Variable):
-        if not term.name in var_map:
-            var_map[term.name] = rdflib.term.Variable(term.name)
-        return var_map[term.name]
+        # unbound variables need no prolog_eval() - pseudo-variables
+        # (e.g. C:user) are resolved by prolog_eval() though
 
-    return pl_literal_to_rdf(a, kb)
+        name = term.name
 
-def _prolog_relational_expression (op, args, env, pe, var_map, kb):
+        if _eval is None or (not env.get(name) and not ':' in name):
+            return _rdf_variable(name, var_map, vars_set)
+
+        term = _eval(term, env)
+        if not term:
+            return _rdf_variable(name, var_map, vars_set)
+
+    elif _eval is not None:
+        term = _eval(term, env)
+
+    return pl_literal_to_rdf(term, kb)
+
+def pl_to_rdf(term, env, pe, var_map, kb, vars_set=None):
+
+    """ var_map collects the rdflib variables created along the way,
+        if given, vars_set is kept in sync with var_map.values() """
+
+    return _term_to_rdf(term, env, pe.prolog_eval if pe else None, var_map, kb, vars_set)
+
+def pl_triple_to_rdf(s, p, o, env, pe, var_map, kb, vars_set=None):
+
+    """ same as calling pl_to_rdf() on each of s, p, o, but
+        with the prolog_eval lookup shared between the three terms """
+
+    _eval = pe.prolog_eval if pe else None
+
+    return (_term_to_rdf(s, env, _eval, var_map, kb, vars_set),
+            _term_to_rdf(p, env, _eval, var_map, kb, vars_set),
+            _term_to_rdf(o, env, _eval, var_map, kb, vars_set))
+
+def _prolog_relational_expression (op, args, env, pe, var_map, kb, vars_set):
 
     if len(args) != 2:
         raise PrologError ('_prolog_relational_expression: 2 args expected.')
 
-    expr  = prolog_to_filter_expression (args[0], env, pe, var_map, kb)
-    other = prolog_to_filter_expression (args[1], env, pe, var_map, kb)
+    expr  = prolog_to_filter_expression (args[0], env, pe, var_map, kb, vars_set)
+    other = prolog_to_filter_expression (args[1], env, pe, var_map, kb, vars_set)
 
     return CompValue ('RelationalExpression', 
                       op=op, 
                       expr  = expr,
                       other = other,
-                      _vars = set(var_map.values()))
+                      _vars = vars_set.copy())
 
-def _prolog_conditional_expression (name, args, env, pe, var_map, kb):
+def _prolog_conditional_expression (name, args, env, pe, var_map, kb, vars_set):
 
     if len(args) != 2:
         raise PrologError ('_prolog_conditional_expression %s: 2 args expected.' % name)
 
     return CompValue (name, 
-                      expr  = prolog_to_filter_expression (args[0], env, pe, var_map, kb),
-                      other = [ prolog_to_filter_expression (args[1], env, pe, var_map, kb) ],
-                      _vars = set(var_map.values()))
+                      expr  = prolog_to_filter_expression (args[0], env, pe, var_map, kb, vars_set),
+                      other = [ prolog_to_filter_expression (args[1], env, pe, var_map, kb, vars_set) ],
+                      _vars = vars_set.copy())
 
-def prolog_to_filter_expression(e, env, pe, var_map, kb):
+def _prolog_lang_expression (name, args, env, pe, var_map, kb, vars_set):
 
-    if isinstance (e, Predicate):
-    
-        if e.name == '=':
-            return _prolog_relational_expression ('=', e.args, env, pe, var_map, kb)
-        elif e.name == '\=':
-            return _prolog_relational_expression ('!=', e.args, env, pe, var_map, kb)
-        elif e.name == '<':
-            return _prolog_relational_expression ('<', e.args, env, pe, var_map, kb)
-        elif e.name == '>':
-            return _prolog_relational_expression ('>', e.args, env, pe, var_map, kb)
-        elif e.name == '=<':
-            return _prolog_relational_expression ('<=', e.args, env, pe, var_map, kb)
-        elif e.name == '>=':
-            return _prolog_relational_expression ('>=', e.args, env, pe, var_map, kb)
-        elif e.name == 'is':
-            pre = _prolog_relational_expression ('is', e.args, env, pe, var_map, kb)
-            return pre
-        elif e.name == 'and':
-            return _prolog_conditional_expression ('ConditionalAndExpression', e.args, env, pe, var_map, kb)
-        elif e.name == 'or':
-            return _prolog_conditional_expression ('ConditionalOrExpression', e.args, env, pe, var_map, kb)
-        elif e.name == 'lang':
-            if len(e.args) != 1:
-                raise PrologError ('lang filter expression: one argument expected.')
-
-            return CompValue ('Builtin_LANG', 
-                              arg  = prolog_to_filter_expression (e.args[0], env, pe, var_map, kb),
-                              _vars = set(var_map.values()))
-
-    return pl_to_rdf (e, env, pe, var_map, kb)
+    if len(args) != 1:
+        raise PrologError ('lang filter expression: one argument expected.')
+
+    return CompValue (name, 
+                      arg  = prolog_to_filter_expression (args[0], env, pe, var_map, kb, vars_set),
+                      _vars = vars_set.copy())
+
+#
+# prolog operator -> (builder, sparql algebra operator), so each node of
+# a filter expression costs a single dict lookup
+#
+
+_FILTER_EXPRESSIONS = {
+                        '='   : (_prolog_relational_expression,  '='),
+                        '\\='  : (_prolog_relational_expression,  '!='),
+                        '<'   : (_prolog_relational_expression,  '<'),
+                        '>'   : (_prolog_relational_expression,  '>'),
+                        '=<'  : (_prolog_relational_expression,  '<='),
+                        '>='  : (_prolog_relational_expression,  '>='),
+                        'is'  : (_prolog_relational_expression,  'is'),
+                        'and' : (_prolog_conditional_expression, 'ConditionalAndExpression'),
+                        'or'  : (_prolog_conditional_expression, 'ConditionalOrExpression'),
+                        'lang': (_prolog_lang_expression,        'Builtin_LANG'),
+                      }
+
+def prolog_to_filter_expression(e, env, pe, var_map, kb, vars_set):
+
+    if type(e) is Predicate or isinstance (e, Predicate):
+
+        fe = _FILTER_EXPRESSIONS.get(e.name)
+        if fe is not None:
+            f, op = fe
+            return f (op, e.args, env, pe, var_map, kb, vars_set)
+
+    return pl_to_rdf (e, env, pe, var_map, kb, vars_set)
+
+def prolog_and_list_to_filter_expression(args, env, pe, var_map, kb, vars_set):
+
+    """ conjunction of a list of prolog filter expressions. sparql's
+        ConditionalAndExpression takes any number of operands (expr, other[]),
+        so this builds a single node instead of a nested and-tree """
+
+    if len(args) == 0:
+        raise PrologError ('filter: at least one expression expected.')
+
+    exprs = [ prolog_to_filter_expression (a, env, pe, var_map, kb, vars_set) for a in args ]
+
+    if len(exprs) == 1:
+        return exprs[0]
 
+    return CompValue ('ConditionalAndExpression', 
+                      expr  = exprs[0],
+                      other = exprs[1:],
+                      _vars = vars_set.copy())
@@ -21,23 +21,18 @@
 # HAL-Prolog runtime with builtin predicates for AI use
 #
 
-import sys
 import datetime
-import dateutil.parser
 import time
-import pytz # $ pip install pytz
+import functools
 import rdflib
 from rdflib.plugins.sparql.parserutils import CompValue
 import logging
 
-from tzlocal import get_localzone # $ pip install tzlocal
-
 from zamiaprolog.runtime import PrologRuntime
 from zamiaprolog.errors  import PrologRuntimeError
 from zamiaprolog.logic   import NumberLiteral, StringLiteral, ListLiteral, Variable, Predicate
-from pl2rdf              import pl_to_rdf, pl_literal_to_rdf, prolog_to_filter_expression, rdf_to_pl
+from pl2rdf              import pl_to_rdf, pl_triple_to_rdf, pl_literal_to_rdf, prolog_and_list_to_filter_expression, rdf_to_pl
 from nltools.tokenizer   import tokenize
-from nltools.misc        import edit_distance
 
 import model
 
@@ -50,6 +45,13 @@ DEFAULT_USER       = USER_PREFIX + u'default'
 TEST_USER          = USER_PREFIX + u'test'
 TEST_TIME          = time.mktime(datetime.datetime(2016,12,06,13,28,6).timetuple())
 MAX_CONTEXT_LEN    = 6
+MAX_RDF_PLANS      = 1024
+MAX_TOKENIZE_CACHE = 4096
+
+# the context graph is only used to name the graph of context quads, so a
+# single instance is shared instead of building a Graph per runtime / turn
+
+CONTEXT_GRAPH      = rdflib.Graph(identifier=CONTEXT_GRAPH_NAME)
 
 ACTION_VARNAME     = '__ACTION__'
 
@@ -59,20 +61,20 @@ def builtin_context_get(g, pe):
 
     pe._trace ('CALLED BUILTIN context_get', g)
 
-    pred = g.terms[g.inx]
-    args = pred.args
+    env  = g.env
+    args = g.terms[g.inx].args
     if len(args) != 2:
         raise PrologRuntimeError('context_get: 2 args expected.')
 
     key     = args[0].name
-    arg_v   = pe.prolog_get_variable(args[1], g.env)
+    arg_v   = pe.prolog_get_variable(args[1], env)
 
     v = pe.read_context(key)
     if not v:
         # import pdb; pdb.set_trace()
         return False
 
-    g.env[arg_v] = v
+    env[arg_v] = v
 
     return True
 
@@ -98,7 +100,7 @@ def builtin_action_context_set(pe, args):
 
     """ context_set(+Name, +Value) """
 
-    logging.debug ('CALLED BUILTIN ACTION context_set %s' % repr(args))
+    logging.debug ('CALLED BUILTIN ACTION context_set %r', args)
 
     if len(args) != 2:
         raise PrologRuntimeError('context_push: 2 args expected.')
@@ -114,7 +116,7 @@ def builtin_action_context_push(pe, args):
 
     """ context_push(+Name, +Value) """
 
-    logging.debug ('CALLED BUILTIN ACTION context_push %s' % repr(args))
+    logging.debug ('CALLED BUILTIN ACTION context_push %r', args)
 
     if len(args) != 2:
         raise PrologRuntimeError('context_push: 2 args expected.')
@@ -132,40 +134,37 @@ def builtin_context_score(g, pe):
 
     pe._trace ('CALLED BUILTIN context_score', g)
 
-    pred = g.terms[g.inx]
-    args = pred.args
+    env  = g.env
+    args = g.terms[g.inx].args
     if len(args) < 4:
         raise PrologRuntimeError('context_score: at least 4 args expected.')
     if len(args) > 5:
         raise PrologRuntimeError('context_score: max 5 args expected.')
 
     key     = args[0].name
-    value   = pe.prolog_eval(args[1], g.env)
-    points  = pe.prolog_get_float(args[2], g.env)
-    scorev  = pe.prolog_get_variable(args[3], g.env)
+    value   = pe.prolog_eval(args[1], env)
+    points  = pe.prolog_get_float(args[2], env)
+    scorev  = pe.prolog_get_variable(args[3], env)
 
     if len(args) == 5:
-        min_score = pe.prolog_get_float(args[4], g.env)
+        min_score = pe.prolog_get_float(args[4], env)
     else:
         min_score = 0.0
 
-    score = g.env[scorev].f if scorev in g.env else 0.0
+    score = env[scorev].f if scorev in env else 0.0
 
     if value:
 
         stack = pe.read_context(key)
 
         if stack:
-            i = 1
-            for v in stack.l:
-                if v == value:
-                    score += points / float(i)
-                    break
-                i += 1
+            pos = next((i for i, v in enumerate(stack.l, 1) if v == value), None)
+            if pos:
+                score += points / float(pos)
 
         if score < min_score:
             return False
-        g.env[scorev] = NumberLiteral(score)
+        env[scorev] = NumberLiteral(score)
         return True
 
     if not isinstance (args[1], Variable):
@@ -175,15 +174,11 @@ def builtin_context_score(g, pe):
 
     stack = pe.read_context(key)
     if stack:
-        i = 1
-        for v in stack.l:
+        argname = args[1].name
+        for i, v in enumerate(stack.l, 1):
             s = score + points / float(i)
             if s >= min_score:
-                res.append({ 
-                             args[1].name : v, 
-                             scorev       : NumberLiteral(score + points / float(i))
-                            })
-            i += 1
+                res.append({ argname : v, scorev : NumberLiteral(s) })
     else:
         if score >= min_score:
             res.append({ 
@@ -196,19 +191,17 @@ def builtin_context_score(g, pe):
 
 def _queue_action(g, action):
 
-    if not ACTION_VARNAME in g.env:
-        g.env[ACTION_VARNAME] = []
-
-    g.env[ACTION_VARNAME].append( action )
+    g.env.setdefault(ACTION_VARNAME, []).append( action )
 
 def builtin_action(g, pe):
 
     pe._trace ('CALLED BUILTIN action', g)
 
-    pred = g.terms[g.inx]
-    args = pred.args
+    env  = g.env
+    args = g.terms[g.inx].args
 
-    evaluated_args = map (lambda v: pe.prolog_eval(v, g.env), args)
+    _eval          = pe.prolog_eval
+    evaluated_args = [_eval(v, env) for v in args]
 
     _queue_action (g, evaluated_args)
 
@@ -220,13 +213,13 @@ def builtin_say(g, pe):
 
     pe._trace ('CALLED BUILTIN say', g)
 
-    pred = g.terms[g.inx]
-    args = pred.args
+    env  = g.env
+    args = g.terms[g.inx].args
     if len(args) != 2:
         raise PrologRuntimeError('say: 2 args expected.')
 
-    arg_L   = pe.prolog_eval(args[0], g.env).name
-    arg_S   = pe.prolog_get_string(args[1], g.env)
+    arg_L   = pe.prolog_eval(args[0], env).name
+    arg_S   = pe.prolog_get_string(args[1], env)
 
     _queue_action (g, [Predicate('say'), arg_L, arg_S] )
 
@@ -234,12 +227,14 @@ def builtin_say(g, pe):
 
 def _eoa (g, pe, score):
 
-    if not (ACTION_VARNAME in g.env):
+    env = g.env
+
+    if not (ACTION_VARNAME in env):
         raise PrologRuntimeError('eoa: no action defined.')
 
-    pe.end_action(g.env[ACTION_VARNAME], score)
+    pe.end_action(env[ACTION_VARNAME], score)
 
-    del g.env[ACTION_VARNAME]
+    del env[ACTION_VARNAME]
 
 def builtin_eoa(g, pe):
 
@@ -247,15 +242,15 @@ def builtin_eoa(g, pe):
 
     pe._trace ('CALLED BUILTIN eoa', g)
 
-    pred = g.terms[g.inx]
-    args = pred.args
+    env  = g.env
+    args = g.terms[g.inx].args
 
     if len(args)>1:
         raise PrologRuntimeError('eoa: max 1 arg expected.')
 
     score = 0.0
     if len(args)>0:
-        score = pe.prolog_get_float(args[0], g.env)
+        score = pe.prolog_get_float(args[0], env)
 
     _eoa (g, pe, score)
 
@@ -267,22 +262,22 @@ def builtin_say_eoa(g, pe):
 
     pe._trace ('CALLED BUILTIN say_eoa', g)
 
-    pred = g.terms[g.inx]
-    args = pred.args
+    env  = g.env
+    args = g.terms[g.inx].args
 
     if len(args) < 2:
         raise PrologRuntimeError('say_eoa: at least 2 args expected.')
     if len(args) > 3:
         raise PrologRuntimeError('say_eoa: max 3 args expected.')
 
-    arg_L   = pe.prolog_eval(args[0], g.env).name
-    arg_S   = pe.prolog_get_string(args[1], g.env)
+    arg_L   = pe.prolog_eval(args[0], env).name
+    arg_S   = pe.prolog_get_string(args[1], env)
 
     _queue_action (g, [Predicate('say'), arg_L, arg_S] )
 
     score = 0.0
     if len(args)>2:
-        score = pe.prolog_get_float(args[2], g.env)
+        score = pe.prolog_get_float(args[2], env)
 
     _eoa (g, pe, score)
 
@@ -300,6 +295,128 @@ def builtin_rdf_lists(g, pe):
 
     return _rdf_exec (g, pe, generate_lists=True)
 
+class _RDFQuery(object):
+
+    """ state collected from the arguments of an rdf/rdf_lists call """
+
+    def __init__(self, env, pe, kb):
+
+        self.env              = env
+        self.pe               = pe
+        self.kb               = kb
+
+        self.distinct         = False
+        self.triples          = []
+        self.optional_triples = []
+        self.filters          = []
+        self.limit            = 0
+        self.offset           = 0
+
+        self.var_map          = {}    # string -> rdflib.term.Variable
+        self.var_set          = set() # var_map.values(), maintained by pl_to_rdf
+
+    def triple(self, arg_s, arg_p, arg_o):
+
+        return pl_triple_to_rdf(arg_s, arg_p, arg_o, self.env, self.pe, self.var_map, self.kb, self.var_set)
+
+def _rdf_optional (q, s_args):
+
+    if len(s_args) != 3:
+        raise PrologRuntimeError('rdf: optional: triple arg expected')
+
+    logging.debug ('rdf: optional arg triple: %r', s_args)
+
+    q.optional_triples.append(q.triple(s_args[0], s_args[1], s_args[2]))
+
+def _rdf_filter (q, s_args):
+
+    logging.debug ('rdf: filter structure detected: %r', s_args)
+
+    q.filters.append(prolog_and_list_to_filter_expression(s_args, q.env, q.pe, q.var_map, q.kb, q.var_set))
+
+def _rdf_distinct (q, s_args):
+
+    if len(s_args) != 0:
+        raise PrologRuntimeError('rdf: distinct: unexpected arguments.')
+
+    q.distinct = True
+
+def _rdf_limit (q, s_args):
+
+    if len(s_args) != 1:
+        raise PrologRuntimeError('rdf: limit: one argument expected.')
+
+    q.limit = q.pe.prolog_get_int(s_args[0], q.env)
+
+def _rdf_offset (q, s_args):
+
+    if len(s_args) != 1:
+        raise PrologRuntimeError('rdf: offset: one argument expected.')
+
+    q.offset = q.pe.prolog_get_int(s_args[0], q.env)
+
+def _rdf_triple (q, s_args):
+
+    logging.debug ('rdf: arg triple: %r', s_args)
+
+    q.triples.append(q.triple(s_args[0], s_args[1], s_args[2]))
+
+_RDF_HANDLERS = {
+                  'optional': _rdf_optional,
+                  'filter'  : _rdf_filter,
+                  'distinct': _rdf_distinct,
+                  'limit'   : _rdf_limit,
+                  'offset'  : _rdf_offset,
+                }
+
+def _filter_vars (e, res):
+
+    """ collect the variables a filter expression refers to """
+
+    if isinstance(e, rdflib.term.Variable):
+        res.add(e)
+
+    elif isinstance(e, CompValue):
+        for k, v in e.iteritems():
+            if k != '_vars':
+                _filter_vars(v, res)
+
+    elif isinstance(e, list):
+        for v in e:
+            _filter_vars(v, res)
+
+    return res
+
+def _rdf_plan (args):
+
+    """ split the arguments of an rdf/rdf_lists call into a list of
+        (handler, handler args) steps """
+
+    plan    = []
+    arg_idx = 0
+
+    while arg_idx < len(args):
+
+        arg_s = args[arg_idx]
+
+        # optional, filter, distinct, limit, offset structures
+
+        h = _RDF_HANDLERS.get(arg_s.name) if isinstance(arg_s, Predicate) else None
+        if h:
+            plan.append((h, arg_s.args))
+            arg_idx += 1
+
+        else:
+
+            if arg_idx > len(args)-3:
+                raise PrologRuntimeError('rdf: not enough arguments for triple')
+
+            plan.append((_rdf_triple, (arg_s, args[arg_idx+1], args[arg_idx+2])))
+
+            arg_idx += 3
+
+    return plan
+
 def _rdf_exec (g, pe, generate_lists=False):
 
     # rdflib.plugins.sparql.parserutils.CompValue
@@ -336,125 +453,68 @@ def _rdf_exec (g, pe, generate_lists=False):
     #   _vars = set([rdflib.term.Variable(u'leaderobj'), rdflib.term.Variable(u'label'), rdflib.term.Variable(u'leader')])
     # )
 
-    pred = g.terms[g.inx]
-    args = pred.args
+    env  = g.env
+    kb   = pe.kb
+    args = g.terms[g.inx].args
     # if len(args) == 0 or len(args) % 3 != 0:
     #     raise PrologRuntimeError('rdf: one or more argument triple(s) expected, got %d args' % len(args))
 
-    distinct         = False
-    triples          = []
-    optional_triples = []
-    filters          = []
-    limit            = 0
-    offset           = 0
-
-    arg_idx          = 0
-    var_map          = {} # string -> rdflib.term.Variable
+    q = _RDFQuery(env, pe, kb)
 
-    while arg_idx < len(args):
-
-        arg_s = args[arg_idx]
-
-        # check for optional structure
-        if isinstance(arg_s, Predicate) and arg_s.name == 'optional':
-
-            s_args = arg_s.args
-
-            if len(s_args) != 3:
-                raise PrologRuntimeError('rdf: optional: triple arg expected')
-
-            arg_s = s_args[0]
-            arg_p = s_args[1]
-            arg_o = s_args[2]
-
-            logging.debug ('rdf: optional arg triple: %s' %repr((arg_s, arg_p, arg_o)))
-
-            optional_triples.append((pl_to_rdf(arg_s, g.env, pe, var_map, pe.kb), 
-                                     pl_to_rdf(arg_p, g.env, pe, var_map, pe.kb), 
-                                     pl_to_rdf(arg_o, g.env, pe, var_map, pe.kb)))
-
-            arg_idx += 1
+    for h, h_args in pe.rdf_plan(args):
+        h (q, h_args)
 
-        # check for filter structure
-        elif isinstance(arg_s, Predicate) and arg_s.name == 'filter':
-
-            logging.debug ('rdf: filter structure detected: %s' % repr(arg_s.args))
-
-            s_args = arg_s.args
-
-            # transform multiple arguments into explicit and-tree
-
-            pl_expr = s_args[0]
-            for a in s_args[1:]:
-                pl_expr = Predicate('and', [pl_expr, a])
-
-            filters.append(prolog_to_filter_expression(pl_expr, g.env, pe, var_map, pe.kb))
-            
-            arg_idx += 1
-
-
-        # check for distinct
-        elif isinstance(arg_s, Predicate) and arg_s.name == 'distinct':
-
-            s_args = arg_s.args
-            if len(s_args) != 0:
-                raise PrologRuntimeError('rdf: distinct: unexpected arguments.')
-
-            distinct = True
-            arg_idx += 1
+    triples          = q.triples
+    optional_triples = q.optional_triples
+    filters          = q.filters
+    var_map          = q.var_map
+    var_set          = q.var_set
+    limit            = q.limit
+    offset           = q.offset
+    distinct         = q.distinct
 
-        # check for limit/offset
-        elif isinstance(arg_s, Predicate) and arg_s.name == 'limit':
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug ('rdf: triples: %r', triples)
+        logging.debug ('rdf: optional_triples: %r', optional_triples)
+        logging.debug ('rdf: filters: %r', filters)
 
-            s_args = arg_s.args
-            if len(s_args) != 1:
-                raise PrologRuntimeError('rdf: limit: one argument expected.')
-
-            limit = pe.prolog_get_int(s_args[0], g.env)
-            arg_idx += 1
-
-        elif isinstance(arg_s, Predicate) and arg_s.name == 'offset':
-
-            s_args = arg_s.args
-            if len(s_args) != 1:
-                raise PrologRuntimeError('rdf: offset: one argument expected.')
-
-            offset = pe.prolog_get_int(s_args[0], g.env)
-            arg_idx += 1
-
-        else:
-
-            if arg_idx > len(args)-3:
-                raise PrologRuntimeError('rdf: not enough arguments for triple')
-
-            arg_p = args[arg_idx+1]
-            arg_o = args[arg_idx+2]
+    if len(triples) == 0:
+        raise PrologRuntimeError('rdf: at least one non-optional triple expected')
 
-            logging.debug ('rdf: arg triple: %s' %repr((arg_s, arg_p, arg_o)))
+    var_list = var_map.values()
 
-            triples.append((pl_to_rdf(arg_s, g.env, pe, var_map, pe.kb), 
-                            pl_to_rdf(arg_p, g.env, pe, var_map, pe.kb), 
-                            pl_to_rdf(arg_o, g.env, pe, var_map, pe.kb)))
+    # filters which only refer to variables bound by the mandatory triples
+    # can be applied before the optional triples are joined in
 
-            arg_idx += 3
+    if optional_triples and filters:
 
-    logging.debug ('rdf: triples: %s' % repr(triples))
-    logging.debug ('rdf: optional_triples: %s' % repr(optional_triples))
-    logging.debug ('rdf: filters: %s' % repr(filters))
+        bgp_vars = set()
+        for t in triples:
+            for r in t:
+                if type(r) is rdflib.term.Variable:
+                    bgp_vars.add(r)
 
-    if len(triples) == 0:
-        raise PrologRuntimeError('rdf: at least one non-optional triple expected')
-
-    var_list = var_map.values()
-    var_set  = set(var_list)
+        early_filters = []
+        late_filters  = []
+        for f in filters:
+            if _filter_vars(f, set()) <= bgp_vars:
+                early_filters.append(f)
+            else:
+                late_filters.append(f)
+    else:
+        early_filters = filters
+        late_filters  = []
 
     p = CompValue('BGP', triples=triples, _vars=var_set)
 
+    for f in early_filters:
+        p = CompValue('Filter', p=p, expr = f, _vars=var_set)
+
     for t in optional_triples:
         p = CompValue('LeftJoin', p1=p, p2=CompValue('BGP', triples=[t], _vars=var_set),
                                   expr = CompValue('TrueFilter', _vars=set([])))
 
-    for f in filters:
+    for f in late_filters:
         p = CompValue('Filter', p=p, expr = f, _vars=var_set)
 
     if limit>0:
@@ -465,9 +525,9 @@ def _rdf_exec (g, pe, generate_lists=False):
 
     algebra = CompValue ('SelectQuery', p = p, datasetClause = None, PV = var_list, _vars = var_set)
     
-    result = pe.kb.query_algebra (algebra)
+    result = kb.query_algebra (algebra)
 
-    logging.debug ('rdf: result (len: %d): %s' % (len(result), repr(result)))
+    logging.debug ('rdf: result (len: %d): %r', len(result), result)
 
     if len(result) == 0:
         return False
@@ -476,44 +536,43 @@ def _rdf_exec (g, pe, generate_lists=False):
 
         # bind each variable to list of values
 
-        for binding in result:
-
-            for v in binding.labels:
+        appenders = None
 
-                l = binding[v]
+        for binding in result:
 
-                value = rdf_to_pl(l)
+            # all rows share the same labels, set up the lists from the first one
 
-                if not v in g.env:
-                    g.env[v] = ListLiteral([])
+            if appenders is None:
+                appenders = []
+                for v in binding.labels:
+                    if not v in env:
+                        env[v] = ListLiteral([])
+                    appenders.append((v, env[v].l.append))
 
-                g.env[v].l.append(value)
+            for v, append in appenders:
+                append(rdf_to_pl(binding[v]))
 
         return True
 
     else:
 
-        # turn result into list of bindings
-
-        res_bindings = []
-        for binding in result:
+        # turn result into list of bindings: convert column by column,
+        # then zip the columns into one dict per row. the result can only
+        # be iterated, so fetch the rows once up front.
 
-            res_binding = {}
+        rows   = list(result)
+        labels = list(rows[0].labels) if rows else []
+        cols   = [ [ rdf_to_pl(binding[v]) for binding in rows ] for v in labels ]
 
-            for v in binding.labels:
-
-                l = binding[v]
-
-                value = rdf_to_pl(l)
-
-                res_binding[v] = value
-
-            res_bindings.append(res_binding)
+        if cols:
+            res_bindings = [ dict(zip(labels, row)) for row in zip(*cols) ]
+        else:
+            res_bindings = [ {} for binding in rows ]
 
         if len(res_bindings) == 0 and len(result)>0:
             res_bindings.append({}) # signal success
 
-        logging.debug ('rdf: res_bindings: %s' % repr(res_bindings))
+        logging.debug ('rdf: res_bindings: %r', res_bindings)
 
         return res_bindings
 
@@ -521,7 +580,7 @@ def builtin_action_rdf_assert(pe, args):
 
     """ rdf_assert (+S, +P, +O) """
 
-    logging.debug ('CALLED BUILTIN ACTION rdf_assert %s' % repr(args))
+    logging.debug ('CALLED BUILTIN ACTION rdf_assert %r', args)
 
     if len(args) != 3:
         raise PrologRuntimeError('rdf_assert: 3 args expected, got %d args' % len(args))
@@ -536,14 +595,15 @@ def builtin_action_rdf_assert(pe, args):
                pe.context_gn) ]
 
     pe.kb.addN(quads)
+    pe.clear_context_cache()
 
 
 def builtin_uriref(g, pe):
 
     pe._trace ('CALLED BUILTIN uriref', g)
 
-    pred = g.terms[g.inx]
-    args = pred.args
+    env  = g.env
+    args = g.terms[g.inx].args
     if len(args) != 2:
         raise PrologRuntimeError('uriref: 2 args expected.')
 
@@ -553,7 +613,7 @@ def builtin_uriref(g, pe):
     if not isinstance(args[1], Variable):
         raise PrologRuntimeError('uriref: second argument: variable expected, %s found instead.' % repr(args[1]))
 
-    g.env[args[1].name] = StringLiteral(pe.kb.resolve_aliases_prefixes(args[0].name))
+    env[args[1].name] = StringLiteral(pe.kb.resolve_aliases_prefixes(args[0].name))
 
     return True
 
@@ -561,12 +621,12 @@ def builtin_sparql_query(g, pe):
 
     pe._trace ('CALLED BUILTIN sparql_query', g)
 
-    pred = g.terms[g.inx]
-    args = pred.args
+    env  = g.env
+    args = g.terms[g.inx].args
     if len(args) < 1:
         raise PrologRuntimeError('sparql_query: at least 1 argument expected.')
 
-    query = pe.prolog_get_string(args[0], g.env)
+    query = pe.prolog_get_string(args[0], env)
 
     # logging.debug("builtin_sparql_query called, query: '%s'" % query)
 
@@ -581,82 +641,137 @@ def builtin_sparql_query(g, pe):
 
     # turn result into lists of literals we can then bind to prolog variables
 
-    res_map  = {} 
-    res_vars = {} # variable idx -> variable name
+    res_map    = {} 
+    res_vars   = {} # variable idx -> variable name
+    appenders  = None
+    _rdf_to_pl = rdf_to_pl
 
     for binding in result:
 
-        for v in binding.labels:
-
-            l = binding[v]
+        # all rows share the same labels, set up the columns from the first one
 
-            value = rdf_to_pl(l)
+        if appenders is None:
+            appenders = []
+            for v, v_idx in binding.labels.iteritems():
+                res_map[v]      = []
+                res_vars[v_idx] = v
+                appenders.append((v, res_map[v].append))
 
-            if not v in res_map:
-                res_map[v] = []
-                res_vars[binding.labels[v]] = v
-
-            res_map[v].append(value)
+        for v, append in appenders:
+            append(_rdf_to_pl(binding[v]))
 
     # logging.debug("builtin_sparql_query res_map : '%s'" % repr(res_map))
     # logging.debug("builtin_sparql_query res_vars: '%s'" % repr(res_vars))
 
     # apply bindings to environment vars
 
-    v_idx = 0
-
-    for arg in args[1:]:
+    for v_idx, arg in enumerate(args[1:]):
 
         sparql_var = res_vars[v_idx]
-        prolog_var = pe.prolog_get_variable(arg, g.env)
+        prolog_var = pe.prolog_get_variable(arg, env)
         value      = res_map[sparql_var]
 
         # logging.debug("builtin_sparql_query mapping %s -> %s: '%s'" % (sparql_var, prolog_var, value))
 
-        g.env[prolog_var] = ListLiteral(value)
-
-        v_idx += 1
+        env[prolog_var] = ListLiteral(value)
 
     return True
 
+# tokenize() is a pure function of (lang, str) and the same inputs and
+# templates get tokenized over and over again. tokens are kept as tuples
+# since the lists handed out to prolog may get modified.
+
+_tokenize_cache = {} # (lang, str) -> tuple of tokens
+
+def _tokenize (s, lang):
+
+    global _tokenize_cache
+
+    k = (lang, s)
+
+    tokens = _tokenize_cache.get(k)
+    if tokens is None:
+
+        if len(_tokenize_cache) >= MAX_TOKENIZE_CACHE:
+            _tokenize_cache = {}
+
+        tokens = _tokenize_cache[k] = tuple(tokenize(s, lang=lang))
+
+    return list(tokens)
+
 def builtin_tokenize(g, pe):
 
     """ tokenize (+Lang, +Str, -Tokens) """
 
     pe._trace ('CALLED BUILTIN tokenize', g)
 
-    pred = g.terms[g.inx]
-    args = pred.args
+    env  = g.env
+    args = g.terms[g.inx].args
     if len(args) != 3:
         raise PrologRuntimeError('tokenize: 3 args expected.')
 
-    arg_lang    = pe.prolog_eval (args[0], g.env)
+    arg_lang    = pe.prolog_eval (args[0], env)
     if not isinstance(arg_lang, Predicate) or len(arg_lang.args) >0:
         raise PrologRuntimeError('tokenize: first argument: constant expected, %s found instead.' % repr(args[0]))
 
-    arg_str     = pe.prolog_get_string   (args[1], g.env)
-    arg_tokens  = pe.prolog_get_variable (args[2], g.env)
+    arg_str     = pe.prolog_get_string   (args[1], env)
+    arg_tokens  = pe.prolog_get_variable (args[2], env)
 
-    g.env[arg_tokens] = ListLiteral(tokenize(arg_str, lang=arg_lang.name))
+    env[arg_tokens] = ListLiteral(_tokenize(arg_str, arg_lang.name))
 
     return True
 
+def _edit_distance(s, t):
+
+    """ Levenshtein distance between two token sequences. Tokens are mapped
+        to small ints first so the inner loop compares ints instead of
+        calling Prolog literal __eq__ methods, and only one row of the DP
+        matrix is kept. """
+
+    if len(s) < len(t):
+        s, t = t, s
+    if not t:
+        return len(s)
+
+    try:
+        ids = {}
+        s, t = [ids.setdefault(x, len(ids)) for x in s], [ids.setdefault(x, len(ids)) for x in t]
+    except TypeError:
+        # unhashable tokens (nested lists) are compared as they are
+        pass
+
+    prev = range(len(t)+1)
+    for i, a in enumerate(s, 1):
+        cur  = [i]
+        left = i
+        for j, b in enumerate(t):
+            d = prev[j] if a == b else prev[j] + 1
+            if prev[j+1] + 1 < d:
+                d = prev[j+1] + 1
+            if left + 1 < d:
+                d = left + 1
+            cur.append(d)
+            left = d
+        prev = cur
+
+    return prev[-1]
+
 def builtin_edit_distance(g, pe):
 
     """" edit_distance (+Tokens1, +Tokens2, -Distance) """
 
     pe._trace ('CALLED BUILTIN edit_distance', g)
 
-    pred = g.terms[g.inx]
-    args = pred.args
+    env  = g.env
+    args = g.terms[g.inx].args
     if len(args) != 3:
         raise PrologRuntimeError('edit_distance: 3 args expected.')
 
-    arg_tok1  = pe.prolog_get_list     (args[0], g.env)
-    arg_tok2  = pe.prolog_get_list     (args[1], g.env)
-    arg_dist  = pe.prolog_get_variable (args[2], g.env)
+    arg_tok1  = pe.prolog_get_list     (args[0], env)
+    arg_tok2  = pe.prolog_get_list     (args[1], env)
+    arg_dist  = pe.prolog_get_variable (args[2], env)
 
-    g.env[arg_dist] = NumberLiteral(edit_distance(arg_tok1.l, arg_tok2.l))
+    env[arg_dist] = NumberLiteral(_edit_distance(arg_tok1.l, arg_tok2.l))
 
     return True
 
@@ -673,8 +788,13 @@ class AIPrologRuntime(PrologRuntime):
         # actions
 
         self.action_buffer   = []
+        self.highscore       = 0     # highest score in action_buffer, maintained by end_action()
         self.builtin_actions = {}
 
+        # rdf/rdf_lists argument plans, see rdf_plan()
+
+        self.rdf_plans       = {}
+
         self.register_builtin          ('action',          builtin_action)   # 
         self.register_builtin          ('eoa',             builtin_eoa)      # eoa: End Of Action ([+Score])
 
@@ -685,7 +805,12 @@ class AIPrologRuntime(PrologRuntime):
         # context related functions and predicates
         #
 
-        self.context_gn = rdflib.Graph(identifier=CONTEXT_GRAPH_NAME)
+        self.context_gn    = CONTEXT_GRAPH
+
+        # (user, key) -> value of user props read so far, see read_context()
+        # plus the current CURIN user, see get_user()
+
+        self.clear_context_cache()
 
         self.register_builtin          ('context_get',     builtin_context_get)         # context_get(+Name, -Value)
         self.register_builtin_function ('context_get',     builtin_context_get_fn)      # context_get(+Name)
@@ -710,25 +835,40 @@ class AIPrologRuntime(PrologRuntime):
     def _builtin_action_wrapper (self, name, g, pe):
 
 
-        l = [Predicate(name)]
-        for arg in g.terms[g.inx].args:
-            # logging.debug ('_builtin_action_wrapper: %s arg=%s' % (name, repr(arg)))
-            value = pe.prolog_eval(arg, g.env)
-            l.append(value)
+        env   = g.env
+        _eval = pe.prolog_eval
 
-        if not ACTION_VARNAME in g.env:
-            g.env[ACTION_VARNAME] = []
+        l = [Predicate(name)]
+        l.extend([_eval(arg, env) for arg in g.terms[g.inx].args])
 
-        g.env[ACTION_VARNAME].append( l )
+        env.setdefault(ACTION_VARNAME, []).append( l )
         return True
 
+    def rdf_plan (self, args):
+
+        """ the arguments of an rdf/rdf_lists call are terms of a stored clause
+            which do not change between calls, so we classify them only once.
+            cache entries keep args alive so their id() cannot be reused. """
+
+        entry = self.rdf_plans.get(id(args))
+
+        if entry is None or entry[0] is not args:
+
+            if len(self.rdf_plans) >= MAX_RDF_PLANS:
+                self.rdf_plans = {}
+
+            entry = (args, _rdf_plan(args))
+            self.rdf_plans[id(args)] = entry
+
+        return entry[1]
+
     def register_builtin_action (self, name, f):
         """ builtin actions are not executed right away but added to the current
             action buffer and will get executed when execute_builtin_actions() is called """
 
         self.builtin_actions[name] = f
 
-        self.register_builtin (name, lambda g, pe: self._builtin_action_wrapper(name, g, pe))
+        self.register_builtin (name, functools.partial(self._builtin_action_wrapper, name))
 
     def execute_builtin_actions(self, abuf):
 
@@ -736,7 +876,7 @@ class AIPrologRuntime(PrologRuntime):
 
         for action in abuf['actions']:
 
-            if not isinstance(action[0], Predicate):
+            if type(action[0]) is not Predicate and not isinstance(action[0], Predicate):
                 continue
             name = action[0].name
 
@@ -746,60 +886,61 @@ class AIPrologRuntime(PrologRuntime):
 
     def reset_actions(self):
         self.action_buffer = []
+        self.highscore     = 0
 
     def get_actions(self, highscore_only=True):
 
         if not highscore_only:
             return self.action_buffer
 
-        # determine highest score
-
-        highscore = 0
-        for ab in self.action_buffer:
-
-            logging.debug('get_actions: %s' % repr(ab))
-
-            if ab['score'] > highscore:
-                highscore = ab['score']
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for ab in self.action_buffer:
+                logging.debug('get_actions: %r', ab)
 
         # filter out any lower scoring action:
 
-        hs_actions = []
-        for ab in self.action_buffer:
-            if ab['score'] < highscore:
-                continue
-            hs_actions.append(ab)
-        return hs_actions
+        highscore = self.highscore
+        return [ab for ab in self.action_buffer if ab['score'] >= highscore]
 
     def end_action(self, actions, score):
 
         self.action_buffer.append({'actions': actions, 'score': score})
+        if score > self.highscore:
+            self.highscore = score
         # logging.debug ('end_action -> %s' % repr(self.action_buffer))
 
     #
     # CURIN related helpers
     #
 
-    def get_user (self):
+    def clear_context_cache (self):
 
-        for q in self.kb.filter_quads(s=CURIN, p=KB_PREFIX + u'user'):
-            return q[2]
+        """ has to be called whenever CURIN or user props are modified
+            outside of the runtime """
 
-        return None
+        self.context_cache = {}
+        self.curin_user    = None
+        self.curin_dirty   = True
 
-    def read_curin (self, key):
+    def get_user (self):
 
-        user = self.get_user()
+        """ CURIN is only rewritten between turns (followed by clear_context_cache()),
+            so the user is looked up once and cached until then """
 
-        for q in self.kb.filter_quads(s=user, p=USER_PROP_PREFIX + key):
-            return rdf_to_pl(q[2])
+        if self.curin_dirty:
 
-        user = DEFAULT_USER
+            self.curin_user = None
+            for q in self.kb.filter_quads(s=CURIN, p=KB_PREFIX + u'user'):
+                self.curin_user = q[2]
+                break
 
-        for q in self.kb.filter_quads(s=user, p=USER_PROP_PREFIX + key):
-            return rdf_to_pl(q[2])
+            self.curin_dirty = False
+
+        return self.curin_user
+
+    def read_curin (self, key):
 
-        return None
+        return self.read_context(key)
 
     #
     # manage stored contexts in db
@@ -807,17 +948,30 @@ class AIPrologRuntime(PrologRuntime):
 
     def read_context (self, key):
 
+        """ user props are read many times per turn but written only by actions,
+            so results (including misses) are cached until the next write. """
+
         user = self.get_user()
 
-        for q in self.kb.filter_quads(s=user, p=USER_PROP_PREFIX + key):
-            return rdf_to_pl(q[2])
+        ck = (user, key)
+        if ck in self.context_cache:
+            return self.context_cache[ck]
 
-        user = DEFAULT_USER
+        value = None
 
         for q in self.kb.filter_quads(s=user, p=USER_PROP_PREFIX + key):
-            return rdf_to_pl(q[2])
+            value = rdf_to_pl(q[2])
+            break
+
+        else:
+
+            for q in self.kb.filter_quads(s=DEFAULT_USER, p=USER_PROP_PREFIX + key):
+                value = rdf_to_pl(q[2])
+                break
+
+        self.context_cache[ck] = value
 
-        return None
+        return value
 
     def write_context (self, key, value):
 
@@ -827,6 +981,11 @@ class AIPrologRuntime(PrologRuntime):
 
         v  = pl_literal_to_rdf(value, self.kb)
 
+        # writes are rare compared to reads, so simply drop all cached props
+        # (writes for the default user are visible through every user's fallback)
+
+        self.context_cache = {}
+
         self.kb.remove (  (user, USER_PROP_PREFIX + key, None, self.context_gn)  )
         self.kb.addN   ([ (user, USER_PROP_PREFIX + key,    v, self.context_gn) ])
 
@@ -837,11 +996,12 @@ class AIPrologRuntime(PrologRuntime):
 
         # logging.debug ('context %s before push: %s' % (key, l))
 
-        if not l:
-            l = ListLiteral([])
-        l.l.insert(0, value)
+        # l may be shared through the context cache, so do not modify it in place
 
-        l.l = l.l[:MAX_CONTEXT_LEN]
+        if not l:
+            l = ListLiteral([value])
+        else:
+            l = ListLiteral([value] + l.l[:MAX_CONTEXT_LEN-1])
 
         # logging.debug ('context %s after push: %s' % (key, l))
 
@@ -43,6 +43,8 @@ from sparqlalchemy.ldfmirror     import LDFMirror
 # essentially we have two graphs: dbpedia subset + our own entries
 #
 
+RESOLVE_CACHE_SIZE = 4096
+
 class AIKB(object):
 
     def __init__(self, kbname='kb'):
@@ -67,15 +69,22 @@ class AIKB(object):
 
         self.endpoints = {} # host name -> LDF endpoint
 
+        # resolve_aliases_prefixes() results, cleared whenever
+        # prefixes or aliases change
+
+        self.resolve_cache = {}
+
     def register_prefix(self, prefix, uri):
         self.query_prefixes += "PREFIX %s: <%s>\n" % (prefix, uri)
         self.sas.register_prefix(prefix, uri)
+        self.resolve_cache = {}
 
     def register_endpoint (self, endpoint, uri):
         self.endpoints[endpoint] = uri
 
     def register_alias (self, alias, uri):
         self.sas.register_alias (alias, uri)
+        self.resolve_cache = {}
 
     def register_graph(self, c):
 
@@ -135,7 +144,17 @@ class AIKB(object):
         return self.sas.filter_quads(s=s, p=p, o=o, context=context)
 
     def resolve_aliases_prefixes(self, resource):
-        return self.sas.resolve_shortcuts(resource)
+
+        res = self.resolve_cache.get(resource)
+        if res is None:
+
+            res = self.sas.resolve_shortcuts(resource)
+
+            if len(self.resolve_cache) >= RESOLVE_CACHE_SIZE:
+                self.resolve_cache = {}
+            self.resolve_cache[resource] = res
+
+        return res
 
     def addN_resolve (self, quads):
 
@@ -18,9 +18,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
+import time
 import unittest
 import logging
 import codecs
+import rdflib
+import dateutil.parser
 
 from nltools import misc
 
@@ -31,6 +35,10 @@ from zamiaprolog.logicdb       import LogicDB
 from aiprolog.runtime          import AIPrologRuntime
 from aiprolog.parser           import AIPrologParser
 from aiprolog.nlp_macro_engine import NLPMacroEngine
+from aiprolog.pl2rdf           import pl_literal_to_rdf, rdf_to_pl, prolog_and_list_to_filter_expression
+from zamiaprolog.logic         import StringLiteral, NumberLiteral, ListLiteral, Predicate, Variable
+
+import aiprolog.runtime
 
 from kb import AIKB
 
@@ -242,6 +250,286 @@ class TestAIProlog (unittest.TestCase):
         self.assertEqual (solutions[0]['Y'].l[1].s, u'abc')
         self.assertEqual (solutions[0]['Y'].l[2].name, u'wde:42')
 
+class TestPl2Rdf (unittest.TestCase):
+
+    def test_iri_strings(self):
+
+        for iri in [u'http://ai.zamia.org/kb/', u'https://www.wikidata.org/entity/Q567', u'urn:isbn:0451450523']:
+            r = pl_literal_to_rdf(StringLiteral(iri), None)
+            self.assertEqual (r, rdflib.term.URIRef(iri))
+            self.assertEqual (rdf_to_pl(r).s, iri)
+
+        r = pl_literal_to_rdf(StringLiteral(u'Alice Green'), None)
+        self.assertEqual (r, rdflib.term.Literal(u'Alice Green'))
+
+    def test_integers(self):
+
+        r = rdf_to_pl(rdflib.term.Literal(u'42', datatype=rdflib.namespace.XSD.integer))
+        self.assertEqual (r.f, 42.0)
+        self.assertTrue  (isinstance(r.f, float))
+
+        r = rdf_to_pl(rdflib.term.Literal(u'12345678901234567891', datatype=rdflib.namespace.XSD.integer))
+        self.assertEqual (r.f, 12345678901234567891)
+
+        for v, f in [(u'5.0', 5.0), (u'1e3', 1000.0)]:
+            r = rdf_to_pl(rdflib.term.Literal(v, datatype=rdflib.namespace.XSD.integer))
+            self.assertEqual (r.f, f)
+
+    def test_datetimes(self):
+
+        # results must not depend on whether the value is parsed by the
+        # strptime() shortcut or by dateutil, also in summer time
+
+        tz = os.environ.get('TZ')
+        try:
+            for zone in ['Europe/Berlin', 'America/New_York', 'UTC']:
+                os.environ['TZ'] = zone
+                time.tzset()
+
+                for v in [u'2016-07-06T13:28:06', u'2016-07-06T13:28:06.5', u'2016-07-06T13:28:06+02:00',
+                          u'2016-07-06T13:28:06Z', u'2016-12-06T13:28:06-05:00', u'2016-07-06T13:28:06.5Z']:
+                    r = rdf_to_pl(rdflib.term.Literal(v, datatype=rdflib.namespace.XSD.dateTime))
+                    self.assertEqual (r.f, time.mktime(dateutil.parser.parse(v).timetuple()))
+
+                r = rdf_to_pl(rdflib.term.Literal(u'2016-07-06', datatype=rdflib.namespace.XSD.date))
+                self.assertEqual (r.f, time.mktime(dateutil.parser.parse(u'2016-07-06').timetuple()))
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+
+    def test_filter_and_list(self):
+
+        X, Y = Variable('X'), Variable('Y')
+
+        args = [ Predicate('>',   [X, NumberLiteral(0)]),
+                 Predicate('<',   [X, NumberLiteral(10)]),
+                 Predicate('\\=', [Y, NumberLiteral(5)]) ]
+
+        # a single expression is used as-is
+
+        e = prolog_and_list_to_filter_expression(args[:1], {}, None, {}, None, set())
+        self.assertEqual (e.name, 'RelationalExpression')
+        self.assertEqual (e.op, '>')
+
+        # more than one: one n-ary and-node, not a nested and-tree
+
+        e = prolog_and_list_to_filter_expression(args, {}, None, {}, None, set())
+        self.assertEqual (e.name, 'ConditionalAndExpression')
+        self.assertEqual (e.expr.name, 'RelationalExpression')
+        self.assertEqual (e.expr.op, '>')
+        self.assertEqual ([o.name for o in e.other], ['RelationalExpression', 'RelationalExpression'])
+        self.assertEqual ([o.op for o in e.other], ['<', '!='])
+
+def _rdf_node(n):
+    if n is None or isinstance(n, rdflib.term.Node):
+        return n
+    return rdflib.term.URIRef(n)
+
+class GraphKB (object):
+
+    """ minimal in-memory stand-in for AIKB: query_algebra() records the
+        algebra and answers every query with the (real rdflib) result of a
+        fixed sparql query """
+
+    def __init__(self, sparql=None):
+        self.graph   = rdflib.ConjunctiveGraph()
+        self.sparql  = sparql
+        self.scans   = 0
+        self.algebra = None
+
+    def resolve_aliases_prefixes(self, resource):
+        return resource
+
+    def query_algebra(self, algebra):
+        self.algebra = algebra
+        return self.graph.query(self.sparql)
+
+    def filter_quads(self, s=None, p=None, o=None, context=None):
+        self.scans += 1
+        return list(self.graph.quads((_rdf_node(s), _rdf_node(p), _rdf_node(o), None)))
+
+    def addN(self, quads):
+        self.graph.addN([ (_rdf_node(s), _rdf_node(p), _rdf_node(o), c) for s, p, o, c in quads ])
+
+    def remove(self, quad):
+        s, p, o, c = quad
+        self.graph.remove((_rdf_node(s), _rdf_node(p), _rdf_node(o), c))
+
+class Goal (object):
+
+    def __init__(self, name, args):
+        self.terms = [Predicate(name, args)]
+        self.inx   = 0
+        self.env   = {}
+
+class TestRdfExec (unittest.TestCase):
+
+    def setUp(self):
+
+        self.kb = GraphKB('SELECT ?X ?Y WHERE { ?X <http://ex.org/p> ?Y } ORDER BY ?Y')
+        for i in range(3):
+            self.kb.graph.add((rdflib.term.URIRef(u'http://ex.org/s%d' % i), 
+                               rdflib.term.URIRef(u'http://ex.org/p'), 
+                               rdflib.term.Literal(i)))
+
+        self.prolog_rt = AIPrologRuntime(None, self.kb)
+
+    def test_rdf_lists(self):
+
+        g = Goal('rdf_lists', [Variable('X'), Variable('P'), Variable('Y')])
+        self.assertTrue (aiprolog.runtime._rdf_exec(g, self.prolog_rt, generate_lists=True))
+
+        self.assertEqual ([v.s for v in g.env['X'].l], [u'http://ex.org/s0', u'http://ex.org/s1', u'http://ex.org/s2'])
+        self.assertEqual ([v.f for v in g.env['Y'].l], [0.0, 1.0, 2.0])
+
+    def test_rdf_bindings(self):
+
+        g = Goal('rdf', [Variable('X'), Variable('P'), Variable('Y')])
+        res = aiprolog.runtime._rdf_exec(g, self.prolog_rt)
+
+        self.assertEqual (len(res), 3)
+        self.assertEqual ([(b['X'].s, b['Y'].f) for b in res], 
+                          [(u'http://ex.org/s0', 0.0), (u'http://ex.org/s1', 1.0), (u'http://ex.org/s2', 2.0)])
+
+    def test_rdf_filter_placement(self):
+
+        X, Y, Z = Variable('X'), Variable('Y'), Variable('Z')
+
+        g = Goal('rdf', [X, StringLiteral(u'http://ex.org/p'), Y,
+                         Predicate('optional', [X, StringLiteral(u'http://ex.org/q'), Z]),
+                         Predicate('filter', [Predicate('>', [Y, NumberLiteral(0)])]),
+                         Predicate('filter', [Predicate('=', [Z, NumberLiteral(1)])])])
+        aiprolog.runtime._rdf_exec(g, self.prolog_rt)
+
+        # the filter on the mandatory Y is applied below the optional join,
+        # the filter on the optional Z stays on top
+
+        p = self.kb.algebra.p
+
+        self.assertEqual (p.name, 'Filter')
+        self.assertEqual (p.expr.op, '=')
+
+        self.assertEqual (p.p.name, 'LeftJoin')
+        self.assertEqual (p.p.p1.name, 'Filter')
+        self.assertEqual (p.p.p1.expr.op, '>')
+        self.assertEqual (p.p.p1.p.name, 'BGP')
+
+class TestContextCache (unittest.TestCase):
+
+    def setUp(self):
+
+        self.kb        = GraphKB()
+        self.prolog_rt = AIPrologRuntime(None, self.kb)
+
+        self.set_user(u'alice')
+
+    def set_user(self, name):
+
+        # same as the kernel does at the start of each turn
+
+        gn = self.prolog_rt.context_gn
+        self.kb.remove((aiprolog.runtime.CURIN, None, None, gn))
+        self.kb.addN([(aiprolog.runtime.CURIN, aiprolog.runtime.KB_PREFIX + u'user', aiprolog.runtime.USER_PREFIX + name, gn)])
+        self.prolog_rt.clear_context_cache()
+
+    def test_read_cache(self):
+
+        self.assertEqual (self.prolog_rt.read_context('topic'), None)
+
+        self.prolog_rt.write_context('topic', StringLiteral(u'weather'))
+
+        value = self.prolog_rt.read_context('topic')
+        self.assertEqual (value.s, u'weather')
+
+        # repeated reads are answered from the cache, including the CURIN user
+
+        scans = self.kb.scans
+        self.assertTrue (self.prolog_rt.read_context('topic') is value)
+        self.assertTrue (self.prolog_rt.read_curin('topic') is value)
+        self.assertEqual (self.kb.scans, scans)
+
+    def test_write_invalidation(self):
+
+        self.prolog_rt.write_context('topic', StringLiteral(u'weather'))
+        self.assertEqual (self.prolog_rt.read_context('topic').s, u'weather')
+
+        self.prolog_rt.write_context('topic', StringLiteral(u'music'))
+        self.assertEqual (self.prolog_rt.read_context('topic').s, u'music')
+
+        self.prolog_rt.push_context('topics', StringLiteral(u'news'))
+        self.prolog_rt.push_context('topics', StringLiteral(u'sports'))
+        self.assertEqual ([v.s for v in self.prolog_rt.read_context('topics').l], [u'sports', u'news'])
+
+    def test_default_user(self):
+
+        self.assertEqual (self.prolog_rt.read_context('lang'), None)
+
+        self.set_user(u'default')
+        self.prolog_rt.write_context('lang', StringLiteral(u'en'))
+        self.assertEqual (self.prolog_rt.read_context('lang').s, u'en')
+
+        # alice falls back to the default user's props
+
+        self.set_user(u'alice')
+        self.assertEqual (self.prolog_rt.read_context('lang').s, u'en')
+
+    def test_rdf_assert_invalidation(self):
+
+        self.assertEqual (self.prolog_rt.read_context('name'), None)
+
+        aiprolog.runtime.builtin_action_rdf_assert(self.prolog_rt, 
+                                                   [StringLiteral(aiprolog.runtime.USER_PREFIX + u'alice'), 
+                                                    StringLiteral(aiprolog.runtime.USER_PROP_PREFIX + u'name'), 
+                                                    StringLiteral(u'Alice Green')])
+
+        self.assertEqual (self.prolog_rt.read_context('name').s, u'Alice Green')
+
+    def test_clear_invalidation(self):
+
+        self.assertEqual (self.prolog_rt.read_context('name'), None)
+
+        # changes made outside the runtime become visible once the cache is cleared
+
+        self.kb.addN([(aiprolog.runtime.USER_PREFIX + u'alice', aiprolog.runtime.USER_PROP_PREFIX + u'name', 
+                       rdflib.term.Literal(u'Alice Green'), self.prolog_rt.context_gn)])
+        self.prolog_rt.clear_context_cache()
+
+        self.assertEqual (self.prolog_rt.read_context('name').s, u'Alice Green')
+
+        self.kb.remove((aiprolog.runtime.CURIN, None, None, self.prolog_rt.context_gn))
+        self.kb.addN([(aiprolog.runtime.CURIN, aiprolog.runtime.KB_PREFIX + u'user', 
+                       aiprolog.runtime.USER_PREFIX + u'bob', self.prolog_rt.context_gn)])
+        self.prolog_rt.clear_context_cache()
+
+        self.assertEqual (self.prolog_rt.read_context('name'), None)
+
+class TestEditDistance (unittest.TestCase):
+
+    def test_edit_distance(self):
+
+        # results must match the nltools reference implementation for plain
+        # strings, prolog literals and unhashable (nested list) tokens
+
+        words  = [ (u'', u''), (u'hello', u''), (u'kitten', u'sitting'), (u'abc', u'cab'),
+                   (u'hello computer how are you', u'hello how are you doing today') ]
+
+        for s, t in words:
+
+            sl = [ StringLiteral(w) for w in s.split() ]
+            tl = [ StringLiteral(w) for w in t.split() ]
+
+            cases = [ (list(s), list(t)),
+                      (s.split(), t.split()),
+                      (sl, tl),
+                      ([ ListLiteral([w]) for w in sl ], tl + [ ListLiteral([w]) for w in tl ]) ]
+
+            for a, b in cases:
+                self.assertEqual (aiprolog.runtime._edit_distance(a, b), misc.edit_distance(a, b))
+                self.assertEqual (aiprolog.runtime._edit_distance(b, a), misc.edit_distance(b, a))
+
 class TestMacroEngine (unittest.TestCase):
 
     def setUp(self):